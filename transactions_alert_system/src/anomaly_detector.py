@@ -1,32 +1,117 @@
+import logging
 import pathlib
+import re
 from typing import Optional, Tuple
 
 import numpy as np
 import pandas as pd
+from pandas.api.typing import SeriesGroupBy
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
-from sqlmodel import Session, select
+from sqlmodel import Session, insert, select
 
 from .models import (
+    TIME_REGEX,
     AlertLevel,
     AnomalyBase,
     BaselineDB,
-    Stats,
+    StatsLite,
     TransactionBase,
     TransactionDB,
     TransactionStatus,
 )
 
-BAD_STATUS: list[str] = ["failed", "denied", "reversed", "backend_reversed"]
+BAD_STATUS: frozenset[str] = frozenset(
+    {"failed", "denied", "reversed", "backend_reversed"}
+)
+TIME_PATTERN = re.compile(TIME_REGEX)
+
+# Baselines are stored in flat arrays indexed by hour * NSTATUS + status code
+STATUS_CODE: dict[str, int] = {s.value: i for i, s in enumerate(TransactionStatus)}
+NSTATUS = len(STATUS_CODE)
+HOURS = 24
+
+# BAD_STATUS membership indexed by status code
+BAD_MASK = np.array([status in BAD_STATUS for status in STATUS_CODE], dtype=bool)
+
+logger = logging.getLogger(__name__)
+
+# Integer alert codes produced by _alert_levels
+ALERT_LEVELS: tuple[Optional[AlertLevel], ...] = (
+    None,
+    AlertLevel.WARNING,
+    AlertLevel.CRITICAL,
+)
+
+
+def _alert_levels(
+    counts: np.ndarray,
+    z_scores: np.ndarray,
+    p95: np.ndarray,
+    p99: np.ndarray,
+    candidates: np.ndarray,
+) -> np.ndarray:
+    """Vectorized alert cascade (0 = no alert, 1 = warning, 2 = critical)"""
+    abs_z = np.abs(z_scores)
+    levels = np.zeros(len(counts), dtype=np.int8)
+    levels[candidates & (counts > p95) & (abs_z > 2)] = 1
+    levels[candidates & (counts > p99) & (abs_z > 3)] = 2
+    return levels
+
+
+def _alert_message(
+    count: int, level: AlertLevel, z_score: float, threshold: float
+) -> str:
+    """Describe why a transaction triggered an alert"""
+    if level == AlertLevel.CRITICAL:
+        return (
+            f"CRITICAL: Count ({count}) exceeds 99th percentile ({threshold:.2f}) "
+            f"and z-score ({z_score:.2f}) > 3, isolation forest: {'anomaly'}"
+        )
+    return (
+        f"WARNING: Count ({count}) exceeds 95th percentile ({threshold:.2f}) "
+        f"and z-score ({z_score:.2f}) > 2, isolation forest: {'anomaly'}"
+    )
+
+
+def _group_stats(grouped: SeriesGroupBy) -> list[tuple[object, StatsLite]]:
+    """Baseline statistics of each group of a grouped count series"""
+    quantiles = grouped.quantile([0.95, 0.99]).unstack()
+    quantiles.columns = ["p95", "p99"]
+    agg = grouped.agg(["mean", "std", "median"]).join(quantiles).fillna({"std": 1.0})
+    return [
+        (
+            row.Index,
+            StatsLite(
+                mean=float(row.mean),
+                std=float(row.std),
+                mad=float(row.median),
+                p95=float(row.p95),
+                p99=float(row.p99),
+            ),
+        )
+        for row in agg.itertuples()
+    ]
 
 
 class AnomalyDetector:
     def __init__(
-        self, session: Session, contamination: float = 0.49, random_state: int = 42
+        self,
+        session: Session,
+        contamination: float = 0.49,
+        random_state: int = 42,
+        debug_csv_path: Optional[str] = None,
     ) -> None:
         self.session = session
-        self.baseline_stats: dict[int, dict[str, Stats]] = {}
+        # When set, detected anomalies are appended to this CSV for debugging
+        self.debug_csv_path = debug_csv_path
+        self.baseline_stats: dict[int, dict[str, StatsLite]] = {}
         self.baseline_features_df: Optional[pd.DataFrame] = None
 
+        # Flattened view of baseline_stats used by the vectorized scoring path
+        self._baseline_arrays: dict[str, np.ndarray] = {}
+        self._build_baseline_arrays()
+
         self.isolation_forest = IsolationForest(
             contamination=contamination, random_state=random_state
         )
@@ -40,39 +125,100 @@ class AnomalyDetector:
         ]
         self._load_baseline()
         self._train_isolation_forest()
+        # Set by update_baseline: the in-memory baseline no longer matches the DB
+        self._stale = False
+
+    def refresh_baseline(self, session: Session) -> None:
+        """Bind to a new session, reloading the baseline only if it was updated"""
+        self.session = session
+        if not self._stale:
+            return
 
-    def _extract_hour_from_time(self, time_str: str) -> int:
-        """Extract hour from time string (e.g., '00h 00' -> 0)"""
-        return int(time_str.split("h")[0])
+        self.baseline_stats = {}
+        self.baseline_features_df = None
+        self.isolation_forest = clone(self.isolation_forest)
+        self._build_baseline_arrays()
+        self._load_baseline()
+        self._train_isolation_forest()
+        self._stale = False
 
     def _get_baseline_by_hour_and_status(self, df: pd.DataFrame) -> None:
         """Get baseline statistics by transaction status and hour"""
-        df["hour"] = df["time"].apply(self._extract_hour_from_time)
-        for hour in df["hour"].unique():
-            hour = int(hour)
-            self.baseline_stats[hour] = {}
-            for status in TransactionStatus:
-                status_data = df[df["status"] == status.value]
-                if not status_data.empty:
-                    stats = Stats(
-                        mean=float(status_data["count"].mean()),
-                        std=float(status_data["count"].std())
-                        if not np.isnan(status_data["count"].std())
-                        else 1.0,
-                        mad=float(status_data["count"].median()),
-                        p95=float(status_data["count"].quantile(0.95)),
-                        p99=float(status_data["count"].quantile(0.99)),
-                    )
-                    self.baseline_stats[hour][status.value] = stats
+        # Times have a fixed "HHh MM" layout (e.g., '00h 00' -> 0)
+        df["hour"] = df["time"].str.slice(0, 2).astype(np.int8)
+
+        # Statuses are a tiny fixed set, so grouping on categorical codes avoids
+        # hashing strings
+        status = df["status"].astype("category")
+        daily_stats = {
+            TransactionStatus(key).value: stats
+            for key, stats in _group_stats(
+                df["count"].groupby(status, observed=True, sort=False)
+            )
+        }
+
+        # Each hour starts from the whole-day stats, so a status never seen in
+        # that hour (e.g., a failure outage) is still scored, then the stats of
+        # every (hour, status) pair present are filled in
+        hourly_stats: dict[int, dict[str, StatsLite]] = {
+            int(hour): dict(daily_stats) for hour in df["hour"].unique()
+        }
+        for (hour, key), stats in _group_stats(
+            df["count"].groupby([df["hour"], status], observed=True, sort=False)
+        ):
+            hourly_stats[int(hour)][TransactionStatus(key).value] = stats
+        self.baseline_stats.update(hourly_stats)
+
+        self._build_baseline_arrays()
+
+    def _build_baseline_arrays(self) -> None:
+        """Flatten baseline statistics into arrays indexed by hour and status.
+
+        Slot hour * NSTATUS + STATUS_CODE[status] holds the statistics of that
+        pair; pairs without a baseline are NaN.
+        """
+        self._baseline_arrays = {
+            field: np.full(HOURS * NSTATUS, np.nan) for field in StatsLite.__slots__
+        }
+        for hour, baseline in self.baseline_stats.items():
+            if not 0 <= hour < HOURS:
+                continue
+            for status, stats in baseline.items():
+                idx = hour * NSTATUS + STATUS_CODE[status]
+                for field, values in self._baseline_arrays.items():
+                    values[idx] = getattr(stats, field)
+
+    def _score_transactions(
+        self, hours: np.ndarray, status_codes: np.ndarray, counts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Vectorized z-scores for a batch of transactions.
+
+        Returns the z-scores and the p95/p99 thresholds of each transaction
+        (NaN thresholds when no baseline exists for its hour and status, so no
+        comparison against them can raise an alert).
+        """
+        idx = hours * NSTATUS + status_codes
+
+        mean = self._baseline_arrays["mean"][idx]
+        z_scores = (counts - mean) * self._baseline_arrays["inv_sigma"][idx]
+        z_scores[np.isnan(mean)] = 0.0
+
+        return (
+            z_scores,
+            self._baseline_arrays["p95"][idx],
+            self._baseline_arrays["p99"][idx],
+        )
 
     def _load_baseline(self) -> None:
         """Load baseline data"""
-        statement = select(TransactionDB)
+        statement = select(
+            TransactionDB.time, TransactionDB.status, TransactionDB.count
+        )
         results = self.session.exec(statement).all()
         if not results:
             return
 
-        df = pd.DataFrame([tx.model_dump() for tx in results])
+        df = pd.DataFrame.from_records(results, columns=["time", "status", "count"])
         self._get_baseline_by_hour_and_status(df)
 
         # Store baseline features for isolation forest training
@@ -85,54 +231,51 @@ class AnomalyDetector:
             and not self.baseline_features_df.empty
         ):
             # Select features for training
-            X = self.baseline_features_df[self.feature_columns].fillna(0)
+            X = self._feature_matrix(self.baseline_features_df)
 
             # Only train if we have sufficient data
             if len(X) > 10:  # Minimum data points for meaningful training
                 self.isolation_forest.fit(X)
-                print(f"Isolation Forest trained on {len(X)} baseline data points")
+                logger.info(
+                    "Isolation Forest trained on %d baseline data points", len(X)
+                )
             else:
-                print("Insufficient baseline data for isolation forest training")
+                logger.info("Insufficient baseline data for isolation forest training")
 
-    def _prepare_features_dataframe(
-        self, transactions: list[TransactionBase] | pd.DataFrame
-    ) -> pd.DataFrame:
+    def _prepare_features_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
         """Prepare features dataframe for isolation forest analysis"""
-        # Convert to DataFrame if it's a list
-        if isinstance(transactions, list):
-            df = pd.DataFrame([tx.model_dump() for tx in transactions])
-        else:
-            df = transactions.copy()
-
         # Pivot data by time and status
-        df_pivot = df.pivot_table(
-            index="time", columns="status", values="count", fill_value=0
-        ).reset_index()
-
-        # Calculate features
-        df_pivot["total_count"] = df_pivot.drop(columns=["time"]).sum(axis=1)
-
-        # Handle bad status columns safely
-        bad_status_cols = [col for col in BAD_STATUS if col in df_pivot.columns]
-        if bad_status_cols:
-            df_pivot["bad_count"] = df_pivot[bad_status_cols].sum(axis=1)
-        else:
-            df_pivot["bad_count"] = 0
-
-        df_pivot["bad_rate"] = df_pivot["bad_count"] / df_pivot["total_count"].replace(
-            0, 1
+        df_pivot = (
+            df.groupby(["time", "status"], observed=True, sort=False)["count"]
+            .mean()
+            .unstack(fill_value=0)
+            .reset_index()
+        )
+
+        # Calculate features on the underlying (time x status) count matrix
+        status_counts = df_pivot.iloc[:, 1:].to_numpy(dtype=np.float64)
+        bad_columns = np.array(
+            [col in BAD_STATUS for col in df_pivot.columns[1:]], dtype=bool
         )
+        total_count = status_counts.sum(axis=1)
+        bad_count = status_counts[:, bad_columns].sum(axis=1)
+
+        df_pivot["total_count"] = total_count
+        df_pivot["bad_count"] = bad_count
+        df_pivot["bad_rate"] = bad_count / np.where(total_count == 0, 1, total_count)
 
         # Sort by time for proper rolling calculations
         df_pivot = df_pivot.sort_values("time").reset_index(drop=True)
 
         window = 60  # minutes
-        df_pivot["rolling_total_mean"] = (
-            df_pivot["total_count"].rolling(window, min_periods=1).mean()
-        )
-        df_pivot["rolling_bad_rate_mean"] = (
-            df_pivot["bad_rate"].rolling(window, min_periods=1).mean()
+        rolling_means = (
+            df_pivot[["total_count", "bad_rate"]]
+            .rolling(window, min_periods=1)
+            .mean()
+            .to_numpy()
         )
+        df_pivot["rolling_total_mean"] = rolling_means[:, 0]
+        df_pivot["rolling_bad_rate_mean"] = rolling_means[:, 1]
 
         df_pivot["delta_total"] = (
             df_pivot["total_count"] - df_pivot["rolling_total_mean"]
@@ -143,112 +286,15 @@ class AnomalyDetector:
 
         return df_pivot
 
+    def _feature_matrix(self, features_df: pd.DataFrame) -> np.ndarray:
+        """Feature columns as a float32 matrix, the dtype sklearn's trees use"""
+        X = features_df[self.feature_columns].to_numpy(dtype=np.float32)
+        X[np.isnan(X)] = 0
+        return X
+
     def _predict_with_isolation_forest(self, features_df: pd.DataFrame) -> np.ndarray:
         """Use pre-trained isolation forest to predict anomalies"""
-        X = features_df[self.feature_columns].fillna(0)
-
-        return self.isolation_forest.predict(X)
-
-    def _calculate_z_score(self, tx: TransactionBase) -> Tuple[float, float, str]:
-        """Calculate z-score for a transaction using baseline statistics"""
-        try:
-            hour = self._extract_hour_from_time(tx.time)
-
-            # Check if baseline exists for this hour and status
-            if (
-                hour not in self.baseline_stats
-                or tx.status.value not in self.baseline_stats[hour]
-            ):
-                return 0.0, 0.0, "No baseline data available"
-
-            baseline = self.baseline_stats[hour][tx.status.value]
-
-            # Use MAD (Median Absolute Deviation) for robust statistics
-            sigma = 1.4826 * baseline.mad if baseline.mad > 0 else baseline.std
-            sigma = max(1.0, sigma)  # Ensure minimum sigma
-
-            z_score = (tx.count - baseline.mean) / sigma
-
-            return z_score, sigma, "Z-score calculated successfully"
-
-        except Exception as e:
-            return 0.0, 0.0, f"Error calculating z-score: {str(e)}"
-
-    def _determine_alert_level(
-        self, tx: TransactionBase, z_score: float, isolation_score: float
-    ) -> Tuple[Optional[AlertLevel], str]:
-        """Determine alert level based on z-score and isolation forest results"""
-        try:
-            hour = self._extract_hour_from_time(tx.time)
-
-            if (
-                hour not in self.baseline_stats
-                or tx.status.value not in self.baseline_stats[hour]
-            ):
-                return None, "No baseline data available"
-
-            baseline = self.baseline_stats[hour][tx.status.value]
-
-            # Determine alert level based on combined analysis
-            if (tx.count > baseline.p99 and abs(z_score) > 3) and isolation_score == -1:
-                return AlertLevel.CRITICAL, (
-                    f"CRITICAL: Count ({tx.count}) exceeds 99th percentile ({baseline.p99:.2f}) "
-                    f"and z-score ({z_score:.2f}) > 3, isolation forest: {'anomaly'}"
-                )
-            elif (
-                tx.count > baseline.p95 and abs(z_score) > 2
-            ) and isolation_score == -1:
-                return AlertLevel.WARNING, (
-                    f"WARNING: Count ({tx.count}) exceeds 95th percentile ({baseline.p95:.2f}) "
-                    f"and z-score ({z_score:.2f}) > 2, isolation forest: {'anomaly'}"
-                )
-
-            return None, "No alert level determined"
-
-        except Exception as e:
-            return None, f"Error determining alert level: {str(e)}"
-
-    def _analyze_transaction(
-        self,
-        tx: TransactionBase,
-        features_df: pd.DataFrame,
-        isolation_predictions: np.ndarray,
-    ) -> Optional[AnomalyBase]:
-        """Analyze a single transaction for anomalies"""
-        # Only check anomalies for bad status transactions
-        if tx.status.value not in BAD_STATUS:
-            return None
-
-        try:
-            # Find the row in features_df that corresponds to this transaction
-            tx_row = features_df[features_df["time"] == tx.time]
-            if tx_row.empty:
-                return None
-
-            tx_index = tx_row.index[0]
-            isolation_score = float(isolation_predictions[tx_index])
-
-            # Calculate z-score
-            z_score, sigma, z_score_msg = self._calculate_z_score(tx)
-
-            # Determine alert level
-            level, message = self._determine_alert_level(tx, z_score, isolation_score)
-            print(message)
-            if level:
-                return AnomalyBase(
-                    time=tx.time,
-                    status=tx.status,
-                    count=tx.count,
-                    level=level,
-                    score=float(z_score),
-                    message=message,
-                )
-
-            return None
-
-        except Exception as e:
-            print(f"Error analyzing transaction {tx.time}: {str(e)}")
-            return None
+        return self.isolation_forest.predict(self._feature_matrix(features_df))
 
     def update_baseline(self, historical_data: pd.DataFrame) -> None:
         """Update baseline using historical data"""
@@ -258,82 +304,135 @@ class AnomalyDetector:
         self.baseline_features_df = self._prepare_features_dataframe(historical_data)
         self._train_isolation_forest()
 
-        # Save to database
-        for hour, baseline in self.baseline_stats.items():
-            for status, stats in baseline.items():
-                self.session.add(
-                    BaselineDB(
-                        **stats.model_dump(),
-                        status=TransactionStatus(status),
-                        hour=hour,
-                    )
-                )
+        # Save to database in a single executemany round trip
+        rows = [
+            {**stats.as_dict(), "status": TransactionStatus(status), "hour": hour}
+            for hour, baseline in self.baseline_stats.items()
+            for status, stats in baseline.items()
+        ]
+        if rows:
+            self.session.execute(insert(BaselineDB), rows)
+        self._stale = True
 
     def detect_anomalies(
         self, transactions: list[TransactionBase]
     ) -> list[AnomalyBase]:
         """Detect anomalies using both z-score analysis and isolation forest"""
-        print(
-            f"\nStarting comprehensive anomaly detection for {len(transactions)} transactions"
+        n = len(transactions)
+        times = np.empty(n, dtype=object)
+        statuses = np.empty(n, dtype=object)
+        times[:] = [tx.time for tx in transactions]
+        statuses[:] = [tx.status for tx in transactions]
+        counts = np.fromiter((tx.count for tx in transactions), dtype=np.int64, count=n)
+        return self.detect_anomalies_vectorized(times, statuses, counts)
+
+    def detect_anomalies_vectorized(
+        self, times: np.ndarray, statuses: np.ndarray, counts: np.ndarray
+    ) -> list[AnomalyBase]:
+        """Columnar detect_anomalies: one array per transaction field"""
+        logger.debug(
+            "Starting comprehensive anomaly detection for %d transactions",
+            len(times),
         )
 
-        if not transactions:
+        # Validate the batch once so the scoring helpers can assume well-formed
+        # "HHh MM" times and known statuses
+        status_codes = pd.Categorical(statuses, categories=list(STATUS_CODE)).codes
+        valid = np.fromiter(
+            (TIME_PATTERN.match(time) is not None for time in times),
+            dtype=bool,
+            count=len(times),
+        ) & (status_codes >= 0)
+        if not valid.all():
+            logger.warning(
+                "Skipping %d transactions with a malformed time or unknown status",
+                (~valid).sum(),
+            )
+        times = np.asarray(times)[valid]
+        statuses = np.asarray(statuses)[valid]
+        counts = np.asarray(counts)[valid]
+        status_codes = status_codes[valid].astype(np.intp)
+
+        if not len(times):
             return []
 
+        hours = np.fromiter(
+            (int(time[:2]) for time in times), dtype=np.intp, count=len(times)
+        )
+        z_scores, p95, p99 = self._score_transactions(
+            hours, status_codes, counts.astype(np.float64)
+        )
+        # Only check anomalies for bad status transactions
+        bad_mask = BAD_MASK[status_codes]
+
         # Check if isolation forest is trained
         if (
             not hasattr(self.isolation_forest, "estimators_")
             or self.isolation_forest.estimators_ is None
         ):
-            print("Warning: Isolation Forest not trained. Using only z-score analysis.")
-            # Fall back to z-score only analysis
-            anomalies: list[AnomalyBase] = []
-            for tx in transactions:
-                if tx.status.value in BAD_STATUS:
-                    z_score, sigma, z_score_msg = self._calculate_z_score(tx)
-                    if abs(z_score) > 3:  # Simple threshold-based alert
-                        anomalies.append(
-                            AnomalyBase(
-                                time=tx.time,
-                                status=tx.status,
-                                count=tx.count,
-                                level=AlertLevel.WARNING,
-                                score=float(z_score),
-                                message=f"Z-score based alert: {z_score:.2f}",
-                            )
-                        )
+            logger.warning("Isolation Forest not trained. Using only z-score analysis.")
+            # Fall back to z-score only analysis with a simple threshold
+            alert_indices = np.flatnonzero(bad_mask & (np.abs(z_scores) > 3))
+            anomalies: list[AnomalyBase] = [
+                AnomalyBase(
+                    time=times[i],
+                    status=statuses[i],
+                    count=int(counts[i]),
+                    level=AlertLevel.WARNING,
+                    score=float(z_scores[i]),
+                    message=f"Z-score based alert: {z_scores[i]:.2f}",
+                )
+                for i in alert_indices
+            ]
             return anomalies
 
         # Prepare features for new transactions
-        features_df = self._prepare_features_dataframe(transactions)
+        features_df = self._prepare_features_dataframe(
+            pd.DataFrame({"time": times, "status": statuses, "count": counts})
+        )
 
         # Use pre-trained isolation forest for predictions (NO RETRAINING)
         isolation_predictions = self._predict_with_isolation_forest(features_df)
 
-        # Analyze each transaction
-        anomalies: list[AnomalyBase] = []
+        # Map each transaction to its isolation forest verdict in one pass
+        feature_rows = pd.Index(features_df["time"]).get_indexer(times)
+        isolation_mask = (feature_rows >= 0) & (
+            isolation_predictions[feature_rows] == -1
+        )
+
+        # Score the whole batch, then only build objects for the flagged rows
+        levels = _alert_levels(
+            counts,
+            z_scores,
+            p95,
+            p99,
+            bad_mask & isolation_mask,
+        )
 
-        for tx in transactions:
-            anomaly = self._analyze_transaction(tx, features_df, isolation_predictions)
-            if anomaly:
-                anomalies.append(anomaly)
+        anomalies: list[AnomalyBase] = []
+        for i in np.flatnonzero(levels):
+            level = ALERT_LEVELS[levels[i]]
+            count = int(counts[i])
+            z_score = float(z_scores[i])
+            threshold = float(p99[i] if level == AlertLevel.CRITICAL else p95[i])
+            anomalies.append(
+                AnomalyBase(
+                    time=times[i],
+                    status=statuses[i],
+                    count=count,
+                    level=level,
+                    score=z_score,
+                    message=_alert_message(count, level, z_score, threshold),
+                )
+            )
 
-        print(f"{len(anomalies)} anomalies detected using combined analysis")
+        logger.debug("%d anomalies detected using combined analysis", len(anomalies))
 
         # Save anomalies to CSV for debugging
-        if anomalies:
-            df_anom = pd.DataFrame([a.model_dump() for a in anomalies])
-            df = df_anom.copy()
-            path = (
-                pathlib.Path.cwd()
-                / "transactions_alert_system"
-                / "data"
-                / "anomalies_detected.csv"
+        if anomalies and self.debug_csv_path:
+            path = pathlib.Path(self.debug_csv_path)
+            pd.DataFrame([a.model_dump() for a in anomalies]).to_csv(
+                path, mode="a", header=not path.exists(), index=False
             )
-            if path.exists():
-                df_old = pd.read_csv(path)
-                df = pd.concat([df_old, df_anom], ignore_index=True)
-                df.sort_values(by=["time", "status"], inplace=True)
-            df.to_csv(path, index=False)
 
         return anomalies
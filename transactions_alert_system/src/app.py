@@ -1,12 +1,16 @@
+import asyncio
 import pathlib
 from contextlib import asynccontextmanager
+from typing import Optional
 
 import pandas as pd
 import plotly.express as px
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI
-from fastapi.responses import HTMLResponse
-from sqlmodel import Session, select
+from fastapi import BackgroundTasks, Depends, FastAPI
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from jinja2 import Environment, FileSystemLoader
+from pydantic import TypeAdapter
+from sqlmodel import Session, func, select
 
 from .anomaly_detector import AnomalyDetector
 from .models import (
@@ -17,15 +21,38 @@ from .models import (
     TransactionDB,
     TransactionQuery,
     TransactionStatus,
+    time_to_minutes,
 )
 from .notification import NotificationService
 from .session import engine, get_session, init_db
 
 DATA_PATH = pathlib.Path.cwd() / "transactions_alert_system" / "data"
+TEMPLATES_PATH = pathlib.Path(__file__).parent / "templates"
 load_dotenv()
 
 WANTS_TRANSACTIONS_2_IN_DB = True  # if you want a clean database, set this to False
 
+# Explicit CSV schema: skips dtype inference and keeps the few statuses as a
+# compact categorical
+CSV_DTYPES = {"time": "string", "status": "category", "count": "int32"}
+
+# Shared detector built once in lifespan; the lock serializes baseline updates
+detector: AnomalyDetector
+detector_lock = asyncio.Lock()
+
+# Serializes /query results straight to JSON, without re-validating DB rows
+TRANSACTIONS_ADAPTER = TypeAdapter(list[TransactionBase])
+
+# Compiled once at import; the figures are trusted Plotly HTML (see |safe)
+DASHBOARD_TEMPLATE = Environment(
+    loader=FileSystemLoader(TEMPLATES_PATH), autoescape=True
+).get_template("dashboard.html.j2")
+
+# The last rendered dashboard, keyed by (hour, last transaction id, last anomaly
+# id); the ids only grow, so older pages are never served again. Cleared
+# whenever the baseline changes
+dashboard_cache: dict[tuple[int, Optional[int], Optional[int]], str] = {}
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -35,32 +62,39 @@ async def lifespan(app: FastAPI):
     with Session(engine) as session:
         global detector
         detector = AnomalyDetector(session)
-        historical_data = pd.read_csv(DATA_PATH / "transactions_1.csv")  # type: ignore
+        historical_data = pd.read_csv(  # type: ignore
+            DATA_PATH / "transactions_1.csv", dtype=CSV_DTYPES
+        )
         detector.update_baseline(historical_data)
+        dashboard_cache.clear()
 
-        existing_data = session.exec(select(TransactionDB)).all()
-        if not existing_data and WANTS_TRANSACTIONS_2_IN_DB:
-            new_data = pd.read_csv(DATA_PATH / "transactions_2.csv")  # type: ignore
-            new_transactions = [
-                TransactionBase(**transaction)  # type: ignore
-                for transaction in new_data.to_dict("records")  # type: ignore
-            ]
-
-            anomalies: list[AnomalyBase] = detector.detect_anomalies(new_transactions)
-
-            for tx in new_transactions:
-                db_tx = TransactionDB(**tx.model_dump())
-                session.add(db_tx)
+        has_data = session.exec(select(TransactionDB.id).limit(1)).first() is not None
+        if not has_data and WANTS_TRANSACTIONS_2_IN_DB:
+            new_data = pd.read_csv(  # type: ignore
+                DATA_PATH / "transactions_2.csv", dtype=CSV_DTYPES
+            )
+            # The CSV is a trusted, known schema: score its columns directly
+            anomalies: list[AnomalyBase] = detector.detect_anomalies_vectorized(
+                new_data["time"].to_numpy(),
+                new_data["status"].to_numpy(),
+                new_data["count"].to_numpy(),
+            )
 
-            for anomaly in anomalies:
-                db_anomaly = AnomalyDB(**anomaly.model_dump())
-                session.add(db_anomaly)
+            session.bulk_insert_mappings(
+                TransactionDB,  # type: ignore
+                new_data.to_dict("records"),  # type: ignore
+            )
+            session.bulk_insert_mappings(
+                AnomalyDB,  # type: ignore
+                [anomaly.model_dump() for anomaly in anomalies],
+            )
 
             session.commit()
     yield
+    notification_service.close()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 notification_service = NotificationService()
 
 
@@ -71,26 +105,53 @@ async def read_root():
     }
 
 
+async def update_baseline(historical_data: pd.DataFrame) -> None:
+    """Fold a processed batch into the detector baseline and persist it"""
+    async with detector_lock:
+        with Session(engine) as session, session.begin():
+            detector.refresh_baseline(session)
+            detector.update_baseline(historical_data)
+        dashboard_cache.clear()
+
+
 @app.post("/transactions", response_model=AnomalyResponse)
 async def process_transactions(
-    transactions: list[TransactionBase], session: Session = Depends(get_session)
+    transactions: list[TransactionBase],
+    background_tasks: BackgroundTasks,
+    session: Session = Depends(get_session),
 ):
-    for tx in transactions:
-        db_tx = TransactionDB(**tx.model_dump())
-        session.add(db_tx)
+    async with detector_lock:
+        # Transactions and their anomalies are committed (or rolled back) together
+        with session.begin():
+            # Score the batch against the history before it, not against itself
+            detector.refresh_baseline(session)
+            anomalies = detector.detect_anomalies(transactions)
+
+            session.bulk_insert_mappings(
+                TransactionDB,  # type: ignore
+                [tx.model_dump() for tx in transactions],
+            )
 
-    detector = AnomalyDetector(session)
-    anomalies = detector.detect_anomalies(transactions)
+            if anomalies:
+                session.bulk_insert_mappings(
+                    AnomalyDB,  # type: ignore
+                    [anomaly.model_dump() for anomaly in anomalies],
+                )
 
+    # Only alert on anomalies that were actually persisted, after responding
     if anomalies:
-        for anomaly in anomalies:
-            db_anomaly = AnomalyDB(**anomaly.model_dump())
-            session.add(db_anomaly)
-        notification_service.send_alert(anomalies)
-
-    detector.update_baseline(pd.DataFrame([tx.model_dump() for tx in transactions]))
-
-    session.commit()
+        background_tasks.add_task(notification_service.send_alert, anomalies)
+
+    # The client does not need to wait for the baseline to be recomputed; an
+    # empty batch has nothing to fold in
+    if transactions:
+        background_tasks.add_task(
+            update_baseline,
+            pd.DataFrame.from_records(
+                [(tx.time, tx.status, tx.count) for tx in transactions],
+                columns=["time", "status", "count"],
+            ),
+        )
 
     return AnomalyResponse(
         message="Transactions processed successfully",
@@ -101,43 +162,53 @@ async def process_transactions(
 @app.post("/query", response_model=list[TransactionBase])
 async def query_transactions(
     query: TransactionQuery, session: Session = Depends(get_session)
-) -> list[TransactionBase]:
-    statement = select(TransactionDB)
+) -> Response:
+    statement = select(TransactionDB.time, TransactionDB.status, TransactionDB.count)
 
     if query.start_hour:
-        statement = statement.where(TransactionDB.time >= query.start_hour)
+        statement = statement.where(
+            TransactionDB.time_minutes >= time_to_minutes(query.start_hour)
+        )
     if query.end_hour:
-        statement = statement.where(TransactionDB.time <= query.end_hour)
+        statement = statement.where(
+            TransactionDB.time_minutes <= time_to_minutes(query.end_hour)
+        )
     if query.status:
         statement = statement.where(TransactionDB.status == query.status)
 
-    transactions = session.exec(statement).all()
-
-    return [
-        TransactionBase(
-            time=tx.time, status=TransactionStatus(tx.status), count=tx.count
-        )
-        for tx in transactions
+    transactions = [
+        TransactionBase.model_construct(time=time, status=status, count=count)
+        for time, status, count in session.exec(statement).all()
     ]
 
+    # response_model still documents the schema; returning a Response skips
+    # FastAPI's validate-then-serialize pass over the whole list
+    return Response(
+        content=TRANSACTIONS_ADAPTER.dump_json(transactions),
+        media_type="application/json",
+    )
+
 
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard(session: Session = Depends(get_session)):
     # get highest hour in the database to present the newest data
-    statement = select(TransactionDB).order_by(TransactionDB.time.desc()).limit(1)
-    result: TransactionDB | None = session.exec(statement).first()
-    hour = int(result.time.split("h")[0]) if result else 23
-
-    statement = select(TransactionDB).where(
-        TransactionDB.time >= f"{hour}h 00", TransactionDB.time <= f"{hour}h 59"
+    last_minute = session.exec(select(func.max(TransactionDB.time_minutes))).one()
+    hour = last_minute // 60 if last_minute is not None else 23
+    start = hour * 60
+    in_hour = TransactionDB.time_minutes.between(start, start + 59)  # type: ignore
+
+    # Serve the cached page unless rows were added since it was rendered
+    cache_key = (
+        hour,
+        session.exec(select(func.max(TransactionDB.id))).one(),
+        session.exec(select(func.max(AnomalyDB.id))).one(),
     )
-    transactions = session.exec(statement).all()
+    cached_html = dashboard_cache.get(cache_key)
+    if cached_html is not None:
+        return cached_html
 
-    print(f"\nFound {len(transactions)} transactions for the last hour")
-    print(
-        "Sample transactions:",
-        [f"{tx.time}: {tx.status}={tx.count}" for tx in transactions[:5]],
-    )
+    statement = select(TransactionDB).where(in_hour)
+    transactions = session.exec(statement).all()
 
     if not transactions:
         return HTMLResponse(
@@ -146,20 +217,20 @@ async def dashboard(session: Session = Depends(get_session)):
 
     df = pd.DataFrame([tx.model_dump() for tx in transactions])
 
-    # Extract hour for sorting and convert to numeric for proper ordering
-    df["hour"] = df["time"].str.extract(r"(\d{2})h").astype(int)
+    # Extract hour for sorting
+    df["hour"] = (df["time_minutes"] // 60).astype("int8")
     df = df.sort_values("hour")
 
     # Get anomalies for the last hour
     anomaly_statement = select(AnomalyDB).where(
-        AnomalyDB.time >= f"{hour}h 00", AnomalyDB.time <= f"{hour}h 59"
+        AnomalyDB.time >= f"{hour:02d}h 00", AnomalyDB.time <= f"{hour:02d}h 59"
     )
     anomalies_db = session.exec(anomaly_statement).all()
-    print(f"\nFound {len(anomalies_db)} anomalies in DB for the last hour")
-    print(
-        "Sample anomalies:",
-        [f"{a.time}: {a.status}={a.count} ({a.level})" for a in anomalies_db[:5]],
-    )
+
+    # Group the anomalies by status in a single pass
+    anomalies_by_status: dict[TransactionStatus, list[AnomalyDB]] = {}
+    for anomaly in anomalies_db:
+        anomalies_by_status.setdefault(anomaly.status, []).append(anomaly)
 
     # Create transaction volume plot
     fig1 = px.line(  # type: ignore
@@ -179,20 +250,10 @@ async def dashboard(session: Session = Depends(get_session)):
         # markers=True,
     )
 
-    print("Anomalies found in DB:", len(anomalies_db))
     # Add special markers for anomalies
     for status in df["status"].unique():
-        # Filter anomalies for this status and print debug info
-        status_anomalies = [a for a in anomalies_db if a.status == status]
-        print(f"Anomalies for status {status}:", len(status_anomalies))
-
+        status_anomalies = anomalies_by_status.get(status)
         if status_anomalies:
-            print(f"Adding markers for {status} anomalies:")
-            for anomaly in status_anomalies:
-                print(
-                    f"  - time: {anomaly.time}, count: {anomaly.count}, level: {anomaly.level}"
-                )
-
             fig1.add_scatter(  # type: ignore
                 x=[a.time for a in status_anomalies],
                 y=[a.count for a in status_anomalies],
@@ -215,7 +276,15 @@ async def dashboard(session: Session = Depends(get_session)):
     )
 
     # Create status breakdown plot
-    status_totals = df.groupby("status")["count"].sum().reset_index()  # type: ignore
+    # Let SQLite sum the counts per status for the hour
+    status_totals = pd.DataFrame.from_records(
+        session.exec(
+            select(TransactionDB.status, func.sum(TransactionDB.count))
+            .where(in_hour)
+            .group_by(TransactionDB.status)
+        ).all(),
+        columns=["status", "count"],
+    )
     fig2 = px.bar(  # type: ignore
         status_totals,
         x="status",
@@ -226,89 +295,26 @@ async def dashboard(session: Session = Depends(get_session)):
     fig2.update_layout(xaxis_title="Status", yaxis_title="Total Count", height=400)  # type: ignore
 
     # Get anomaly statistics
-    detector = AnomalyDetector(session)
-    anomalies = detector.detect_anomalies(
-        [
-            TransactionBase(time=row["time"], status=row["status"], count=row["count"])
-            for _, row in df.iterrows()
-        ]
-    )
+    async with detector_lock:
+        detector.refresh_baseline(session)
+        anomalies = detector.detect_anomalies_vectorized(
+            df["time"].to_numpy(), df["status"].to_numpy(), df["count"].to_numpy()
+        )
 
     critical_count = len([a for a in anomalies if a.level == "CRITICAL"])
     warning_count = len([a for a in anomalies if a.level == "WARNING"])
 
-    dashboard_html = f"""
-    <html>
-        <head>
-            <title>Transaction Monitoring Dashboard</title>
-            <style>
-                .container {{ 
-                    max-width: 1200px; 
-                    margin: 0 auto; 
-                    padding: 20px;
-                }}
-                .plot-container {{ 
-                    margin-bottom: 30px; 
-                    background: white;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                }}
-                .stats-container {{
-                    display: flex;
-                    justify-content: space-around;
-                    margin-bottom: 30px;
-                }}
-                .stat-box {{
-                    background: white;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                    text-align: center;
-                }}
-                .critical {{
-                    color: #dc3545;
-                }}
-                .warning {{
-                    color: #ffc107;
-                }}
-                h1 {{ 
-                    text-align: center; 
-                    color: #333;
-                    margin-bottom: 30px;
-                }}
-                body {{
-                    background: #f5f5f5;
-                    font-family: Arial, sans-serif;
-                }}
-            </style>
-            <meta http-equiv="refresh" content="60">
-        </head>
-        <body>
-            <div class="container">
-                <h1>Transaction Monitoring Dashboard</h1>
-                
-                <div class="stats-container">
-                    <div class="stat-box">
-                        <h3>Chosen Hour ({hour}h)</h3>
-                        <p>Total Transactions: {df["count"].sum()}</p>
-                    </div>
-                    <div class="stat-box">
-                        <h3>Anomalies in Last Hour</h3>
-                        <p class="critical">Critical: {critical_count}</p>
-                        <p class="warning">Warnings: {warning_count}</p>
-                    </div>
-                </div>
-                
-                <div class="plot-container">
-                    {fig1.to_html(full_html=False)} 
-                </div>
-                <div class="plot-container">
-                    {fig2.to_html(full_html=False)}
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    dashboard_html = DASHBOARD_TEMPLATE.render(
+        hour=hour,
+        total_count=status_totals["count"].sum(),
+        critical_count=critical_count,
+        warning_count=warning_count,
+        # plotly.js is loaded once, from its CDN, instead of inlined in each page
+        volume_plot=fig1.to_html(full_html=False, include_plotlyjs="cdn"),
+        status_plot=fig2.to_html(full_html=False, include_plotlyjs=False),
+    )
+
+    dashboard_cache.clear()
+    dashboard_cache[cache_key] = dashboard_html
 
     return dashboard_html
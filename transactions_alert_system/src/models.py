@@ -4,7 +4,7 @@ from typing import Optional
 
 from pydantic import BaseModel
 from pydantic import Field as PydanticField
-from sqlmodel import Field, SQLModel
+from sqlmodel import Field, Index, SQLModel
 
 
 class TransactionStatus(str, Enum):
@@ -17,18 +17,40 @@ class TransactionStatus(str, Enum):
     FAILED = "failed"
 
 
+# "HHh MM" time of day (00h 00 to 23h 59)
+TIME_REGEX = r"^([01]\d|2[0-3])h [0-5]\d$"
+
+
 class TransactionBase(SQLModel):
     time: str = PydanticField(
-        examples=["00h 00", "23h 59"]
+        examples=["00h 00", "23h 59"], pattern=TIME_REGEX
     )  # in a real app would be a datetime
     status: TransactionStatus
     count: int
 
 
+def time_to_minutes(time: str) -> int:
+    """Minute of the day of an "HHh MM" time (e.g., '16h 42' -> 1002)"""
+    return int(time[:2]) * 60 + int(time[4:6])
+
+
+def _time_minutes_default(context) -> int:
+    """Column default deriving time_minutes from the inserted row's time"""
+    return time_to_minutes(context.get_current_parameters()["time"])
+
+
 class TransactionDB(TransactionBase, table=True):
     __tablename__ = "transactions"  # type: ignore
 
     id: Optional[int] = Field(default=None, primary_key=True)
+    # Integer copy of `time` (see time_to_minutes) for cheap range filters, filled
+    # in on insert so callers only ever pass `time`
+    time_minutes: Optional[int] = Field(
+        default=None,
+        index=True,
+        nullable=False,
+        sa_column_kwargs={"default": _time_minutes_default},
+    )
     created_at: datetime = Field(default_factory=datetime.now)
 
 
@@ -48,6 +70,8 @@ class AnomalyBase(SQLModel):
 
 class AnomalyDB(AnomalyBase, table=True):
     __tablename__ = "anomalies"  # type: ignore
+    # Leading "time" column also serves the dashboard's time range lookups
+    __table_args__ = (Index("ix_anomalies_time_status", "time", "status"),)
 
     id: Optional[int] = Field(default=None, primary_key=True)
     created_at: datetime = Field(default_factory=datetime.now)
@@ -66,6 +90,34 @@ class Stats(SQLModel):
     p99: float = 0.0
 
 
+class StatsLite:
+    """Plain-attribute baseline statistics used on the detection hot path"""
+
+    __slots__ = ("mean", "std", "mad", "p95", "p99", "sigma", "inv_sigma")
+
+    def __init__(
+        self, mean: float, std: float, mad: float, p95: float, p99: float
+    ) -> None:
+        self.mean = mean
+        self.std = std
+        self.mad = mad
+        self.p95 = p95
+        self.p99 = p99
+        # Use MAD (Median Absolute Deviation) for robust statistics
+        self.sigma = max(1.0, 1.4826 * mad if mad > 0 else std)
+        self.inv_sigma = 1.0 / self.sigma
+
+    def as_dict(self) -> dict[str, float]:
+        """Fields persisted by Stats-based tables"""
+        return {
+            "mean": self.mean,
+            "std": self.std,
+            "mad": self.mad,
+            "p95": self.p95,
+            "p99": self.p99,
+        }
+
+
 class BaselineDB(Stats, table=True):
     __tablename__ = "baselines"  # type: ignore
 
@@ -77,10 +129,10 @@ class BaselineDB(Stats, table=True):
 
 class TransactionQuery(BaseModel):
     start_hour: Optional[str] = PydanticField(
-        None, examples=["00h 00"], pattern=r"^\d{2}h \d{2}$"
+        None, examples=["00h 00"], pattern=TIME_REGEX
     )
     end_hour: Optional[str] = PydanticField(
-        None, examples=["23h 59"], pattern=r"^\d{2}h \d{2}$"
+        None, examples=["23h 59"], pattern=TIME_REGEX
     )
     status: Optional[TransactionStatus] = None
 
@@ -1,7 +1,9 @@
 import os
 import smtplib
+import threading
 from datetime import datetime
 from email.mime.text import MIMEText
+from typing import Optional
 
 from .models import AnomalyBase
 
@@ -11,10 +13,16 @@ class NotificationService:
         # In production, these would be environment variables
         self.smtp_host = "smtp.gmail.com"
         self.smtp_port = 587
+        # Seconds before a stalled SMTP socket gives up instead of blocking the alert
+        self.smtp_timeout = 10
         self.smtp_user = os.getenv("SMTP_USER", "your-email@gmail.com")
         self.smtp_pass = os.getenv("SMTP_PASS", "your-app-password")
         self.recipients = os.getenv("ALERT_RECIPIENTS", "team@company.com").split(",")
 
+        # Authenticated connection reused across alerts (opened on first send)
+        self._server: Optional[smtplib.SMTP] = None
+        self._lock = threading.Lock()
+
     def send_alert(self, anomalies: list[AnomalyBase]):
         if not anomalies:
             return
@@ -34,13 +42,44 @@ class NotificationService:
             msg["From"] = self.smtp_user
             msg["To"] = ", ".join(self.recipients)
 
-            with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.smtp_user, self.smtp_pass)
-                server.send_message(msg)
+            self._send(msg)
         except Exception as e:
             print(f"Failed to send alert: {str(e)}")
 
+    def close(self) -> None:
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except (smtplib.SMTPException, OSError):
+                    self._server.close()
+                self._server = None
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.smtp_timeout)
+        server.starttls()
+        server.login(self.smtp_user, self.smtp_pass)
+        return server
+
+    def _send(self, msg: MIMEText) -> None:
+        with self._lock:
+            try:
+                if self._server is None:
+                    self._server = self._connect()
+                try:
+                    self._server.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # The server dropped the idle connection: log in again once
+                    self._server = None
+                    self._server = self._connect()
+                    self._server.send_message(msg)
+            except Exception:
+                # Never keep a broken connection around for the next alert
+                if self._server is not None:
+                    self._server.close()
+                    self._server = None
+                raise
+
     def _format_alert_message(
         self,
         critical: list[AnomalyBase],
@@ -1,17 +1,69 @@
 from pathlib import Path
 
+from sqlalchemy import event, inspect, text
 from sqlmodel import Session, SQLModel, create_engine
 
+from .models import time_to_minutes
+
 # Create data directory if it doesn't exist
 DB_DIR = Path.cwd() / "transactions_alert_system" / "data"
 DB_DIR.mkdir(exist_ok=True)
 
 SQLITE_URL = f"sqlite:///{DB_DIR}/transactions.db"
-engine = create_engine(SQLITE_URL)
+engine = create_engine(
+    SQLITE_URL,
+    # Pooled connections are shared across FastAPI's worker threads
+    connect_args={"check_same_thread": False},
+    pool_size=10,
+    pool_pre_ping=True,
+)
+
+# WAL lets readers run alongside a writer, and synchronous=NORMAL only fsyncs at
+# checkpoints instead of on every commit
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def _add_time_minutes_column():
+    """Add and backfill transactions.time_minutes on databases created without it"""
+    columns = {column["name"] for column in inspect(engine).get_columns("transactions")}
+    if "time_minutes" in columns:
+        return
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "ALTER TABLE transactions "
+            "ADD COLUMN time_minutes INTEGER NOT NULL DEFAULT 0"
+        )
+        rows = connection.exec_driver_sql("SELECT id, time FROM transactions").all()
+        if rows:
+            connection.execute(
+                text("UPDATE transactions SET time_minutes = :minutes WHERE id = :id"),
+                [
+                    {"id": row_id, "minutes": time_to_minutes(time)}
+                    for row_id, time in rows
+                ],
+            )
 
 
 def init_db():
     SQLModel.metadata.create_all(engine)
+    _add_time_minutes_column()
+    # create_all skips tables that already exist, so add any missing indexes
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 def get_session():
@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+from sqlmodel import Session, SQLModel, create_engine
+
+from transactions_alert_system.src.anomaly_detector import AnomalyDetector
+from transactions_alert_system.src.models import (
+    AlertLevel,
+    TransactionBase,
+    TransactionStatus,
+)
+
+DATA_PATH = Path(__file__).parents[1] / "data"
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_status_missing_from_an_hour_falls_back_to_whole_day_stats(session):
+    detector = AnomalyDetector(session)
+    detector.update_baseline(
+        pd.DataFrame(
+            {
+                "time": ["16h 00", "16h 01", "17h 00"],
+                "status": ["failed", "failed", "approved"],
+                "count": [2, 4, 100],
+            }
+        )
+    )
+
+    assert detector.baseline_stats[17]["failed"].mean == 3.0
+    assert detector.baseline_stats[17]["approved"].mean == 100.0
+
+
+def test_startup_flags_the_17h_failure_outage(session):
+    """transactions_1.csv has no failed rows at 17h; the outage must still alert"""
+    detector = AnomalyDetector(session)
+    detector.update_baseline(pd.read_csv(DATA_PATH / "transactions_1.csv"))
+
+    new_data = pd.read_csv(DATA_PATH / "transactions_2.csv")
+    anomalies = detector.detect_anomalies(
+        [TransactionBase(**row) for row in new_data.to_dict("records")]
+    )
+
+    failed_at_17h = [
+        a
+        for a in anomalies
+        if a.status == TransactionStatus.FAILED and a.time.startswith("17h")
+    ]
+    assert len(failed_at_17h) == 57
+    assert any(a.level == AlertLevel.CRITICAL for a in failed_at_17h)